@@ -5,7 +5,8 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+import redis.asyncio as aioredis
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
@@ -17,39 +18,83 @@ load_dotenv()
 
 _client = None
 db = None
+cache = None
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
+redis_url = os.getenv("REDIS_URL")
 
-if database_url and database_name:
-    _client = MongoClient(database_url)
-    db = _client[database_name]
+def connect():
+    """Create the clients for the current process (call after workers fork)"""
+    global _client, db, cache
+    if _client is None and database_url and database_name:
+        _client = AsyncIOMotorClient(
+            database_url,
+            maxPoolSize=200,
+            minPoolSize=10,
+            serverSelectionTimeoutMS=2000,
+            socketTimeoutMS=5000,
+            waitQueueTimeoutMS=1000,
+            retryWrites=True,
+            compressors="zstd,zlib",
+            zlibCompressionLevel=6,
+        )
+        db = _client[database_name]
+    if cache is None and redis_url:
+        # fail fast so an unreachable cache falls back to MongoDB quickly
+        cache = aioredis.Redis.from_url(redis_url, socket_connect_timeout=0.2, socket_timeout=0.2)
+    return db
+
+async def close():
+    """Close the clients for the current process"""
+    global _client, db, cache
+    if _client is not None:
+        _client.close()
+    if cache is not None:
+        await cache.close()
+    _client = None
+    db = None
+    cache = None
 
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
-    """Insert a single document with timestamp"""
+async def create_document(collection_name: str, data: Union[BaseModel, dict], extra: dict = None):
+    """Insert a single document with timestamp.
+
+    Pydantic models are stored with only the fields the client set; pass any
+    defaults the server relies on (e.g. status) in `extra`.
+    """
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
 
     # Convert Pydantic model to dict if needed
     if isinstance(data, BaseModel):
-        data_dict = data.model_dump()
+        data_dict = data.model_dump(exclude_unset=True, by_alias=True)
     else:
         data_dict = data.copy()
+    if extra:
+        data_dict.update(extra)
 
     data_dict['created_at'] = datetime.now(timezone.utc)
     data_dict['updated_at'] = datetime.now(timezone.utc)
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
-    """Get documents from collection"""
+def iter_documents(collection_name: str, filter_dict: dict = None, limit: int = None, projection: dict = None):
+    """Return an async cursor over documents with `_id` converted to a string `id` by the server"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
-    
-    cursor = db[collection_name].find(filter_dict or {})
+
+    pipeline = [{"$match": filter_dict or {}}]
     if limit:
-        cursor = cursor.limit(limit)
-    
-    return list(cursor)
+        pipeline.append({"$limit": limit})
+    if projection:
+        pipeline.append({"$project": projection})
+    pipeline.append({"$set": {"id": {"$toString": "$_id"}}})
+    pipeline.append({"$unset": "_id"})
+
+    return db[collection_name].aggregate(pipeline)
+
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None, projection: dict = None):
+    """Get documents from collection with `_id` converted to a string `id` by the server"""
+    return await iter_documents(collection_name, filter_dict, limit, projection).to_list(length=None)
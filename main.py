@@ -1,32 +1,98 @@
 import os
-from fastapi import FastAPI, HTTPException
+import time
+import logging
+import asyncio
+import orjson
+from functools import lru_cache
+from fastapi import FastAPI, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
 from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
 
-from database import db, create_document, get_documents
+import database
+from database import create_document, get_documents, iter_documents
 from schemas import Customer, Technician, Booking, Review, Payment
 
-app = FastAPI(title="On-Call Repairs & Maintenance API", version="1.0.0")
+logger = logging.getLogger(__name__)
+
+app = FastAPI(
+    title="On-Call Repairs & Maintenance API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
+
+# Comma-separated list of allowed frontend origins, e.g. "https://app.example.com"
+cors_origins = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
+    allow_origins=cors_origins,
+    # credentials are only allowed for an explicit origin list; with "*"
+    # Starlette would echo back any Origin on credentialed requests
+    allow_credentials="*" not in cors_origins,
+    allow_methods=["GET", "POST"],
     allow_headers=["*"],
+    max_age=86400,
 )
 
 
+@app.on_event("startup")
+async def connect_db():
+    database.connect()
+
+
+@app.on_event("startup")
+async def ensure_indexes():
+    # create_index is idempotent, so this is safe on every boot; an unreachable
+    # database must not stop the app from starting and reporting it via /test
+    if database.db is not None:
+        try:
+            await database.db["booking"].create_index("status")
+            await database.db["booking"].create_index("technician_id")
+            await database.db["review"].create_index("technician_id")
+            await database.db["payment"].create_index("booking_id")
+        except Exception:
+            logger.exception("Failed to create indexes")
+
+
+@app.on_event("startup")
+async def start_location_writer():
+    if database.db is not None:
+        _start_location_writer()
+
+
+@app.on_event("shutdown")
+async def stop_location_writer():
+    await _stop_location_writer()
+
+
+@app.on_event("shutdown")
+async def close_db():
+    await database.close()
+
+
+_ROOT_BYTES = orjson.dumps({"message": "On-Call Repairs & Maintenance Backend Running"})
+
+
 @app.get("/")
-def read_root():
-    return {"message": "On-Call Repairs & Maintenance Backend Running"}
+async def read_root():
+    return Response(content=_ROOT_BYTES, media_type="application/json")
+
+
+# /test is polled by health checks; reuse the serialized report for a few seconds
+_TEST_CACHE_TTL = 5
+_test_cache = {"expires": 0.0, "body": b""}
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
+    now = time.monotonic()
+    if now < _test_cache["expires"]:
+        return Response(content=_test_cache["body"], media_type="application/json")
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -36,13 +102,13 @@ def test_database():
         "collections": []
     }
     try:
-        if db is not None:
+        if database.db is not None:
             response["database"] = "✅ Connected & Working"
             response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-            response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
+            response["database_name"] = database.db.name if hasattr(database.db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await database.db.list_collection_names()
                 response["collections"] = collections[:10]
             except Exception as e:
                 response["database"] = f"⚠️ Connected but Error: {str(e)[:50]}"
@@ -50,7 +116,9 @@ def test_database():
             response["database"] = "⚠️ Available but not initialized"
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
-    return response
+    _test_cache["body"] = orjson.dumps(response)
+    _test_cache["expires"] = now + _TEST_CACHE_TTL
+    return Response(content=_test_cache["body"], media_type="application/json")
 
 
 # Utilities
@@ -58,127 +126,345 @@ class IdModel(BaseModel):
     id: str
 
 
+class AssignBody(BaseModel):
+    booking_id: str
+    technician_id: str
+
+
+class LocationBody(BaseModel):
+    technician_id: str
+    lat: float
+    lng: float
+
+
+class ConfirmBody(BaseModel):
+    transaction_id: str
+
+
+# Upper bound on documents returned by list endpoints
+MAX_LIST_LIMIT = 500
+
+
+@lru_cache(maxsize=4096)
 def _oid(id_str: str) -> ObjectId:
-    try:
-        return ObjectId(id_str)
-    except Exception:
+    if not ObjectId.is_valid(id_str):
         raise HTTPException(status_code=400, detail="Invalid id")
+    return ObjectId(id_str)
 
 
 # Public schemas endpoint to aid admin tools
+_SCHEMA_CACHE = {
+    "customer": Customer.model_json_schema(),
+    "technician": Technician.model_json_schema(),
+    "booking": Booking.model_json_schema(),
+    "review": Review.model_json_schema(),
+    "payment": Payment.model_json_schema(),
+}
+_SCHEMA_BYTES = orjson.dumps(_SCHEMA_CACHE)
+
+
 @app.get("/schema")
-def get_schema():
-    return {
-        "customer": Customer.model_json_schema(),
-        "technician": Technician.model_json_schema(),
-        "booking": Booking.model_json_schema(),
-        "review": Review.model_json_schema(),
-        "payment": Payment.model_json_schema(),
-    }
+async def get_schema():
+    return Response(content=_SCHEMA_BYTES, media_type="application/json")
 
 
 # Bookings
 @app.post("/bookings", response_model=dict)
-def create_booking(payload: Booking):
-    booking_id = create_document("booking", payload)
+async def create_booking(payload: Booking):
+    booking_id = await create_document("booking", payload, {"status": payload.status})
     return {"id": booking_id}
 
 
+# Free-text fields left out of booking listings unless explicitly requested
+_BOOKING_LIST_PROJECTION = {"notes": 0}
+_BOOKING_FIELDS = frozenset(Booking.model_fields) | {"id"}
+
+
 @app.get("/bookings", response_model=List[dict])
-def list_bookings(status: Optional[str] = None, limit: int = 50):
+async def list_bookings(
+    status: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=MAX_LIST_LIMIT),
+    fields: Optional[str] = None,
+):
     flt = {"status": status} if status else {}
-    docs = get_documents("booking", flt, limit)
-    for d in docs:
-        d["id"] = str(d.get("_id"))
-        d.pop("_id", None)
-    return docs
+    requested = {f.strip() for f in fields.split(",") if f.strip()} if fields else set()
+    unknown = requested - _BOOKING_FIELDS
+    if unknown:
+        raise HTTPException(400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    if requested:
+        # _id is always kept and returned as id
+        projection = {f: 1 for f in requested if f != "id"} or {"_id": 1}
+    else:
+        projection = _BOOKING_LIST_PROJECTION
+    cursor = iter_documents("booking", flt, limit, projection)
+
+    # fetch the first document before streaming starts, so a failing query
+    # still produces an error response rather than a truncated 200 body
+    try:
+        head = await cursor.next()
+    except StopAsyncIteration:
+        await cursor.close()
+        return Response(content=b"[]", media_type="application/json")
+    except Exception:
+        await cursor.close()
+        raise
+
+    # stream the rest as the cursor yields them instead of building the list
+    async def body():
+        try:
+            yield b"["
+            yield orjson.dumps(head)
+            async for d in cursor:
+                yield b","
+                yield orjson.dumps(d)
+            yield b"]"
+        finally:
+            await cursor.close()
+
+    return StreamingResponse(body(), media_type="application/json")
 
 
 @app.post("/bookings/assign", response_model=dict)
-def assign_technician(data: dict):
-    booking_id = data.get("booking_id")
-    technician_id = data.get("technician_id")
-    if not booking_id or not technician_id:
-        raise HTTPException(400, detail="booking_id and technician_id required")
-    r = db["booking"].update_one(
-        {"_id": _oid(booking_id)},
-        {"$set": {"technician_id": technician_id, "status": "assigned", "updated_at": datetime.utcnow()}},
+async def assign_technician(payload: AssignBody):
+    doc = await database.db["booking"].find_one_and_update(
+        {"_id": _oid(payload.booking_id)},
+        {"$set": {"technician_id": payload.technician_id, "status": "assigned", "updated_at": datetime.utcnow()}},
+        projection={"status": 1, "technician_id": 1},
+        return_document=ReturnDocument.AFTER,
     )
-    if r.matched_count == 0:
+    if doc is None:
         raise HTTPException(404, detail="Booking not found")
-    return {"ok": True}
+    return {"ok": True, "id": str(doc["_id"]), "status": doc["status"], "technician_id": doc["technician_id"]}
+
+
+# Location pings are buffered and written in bulk: one round trip per batch
+# instead of one per ping. Only the latest ping per technician is kept.
+_LOCATION_FLUSH_INTERVAL = 0.1
+_LOCATION_BATCH_SIZE = 50
+_LOCATION_QUEUE_SIZE = 10000
+_LOCATION_STOP_TIMEOUT = 5
+_LOCATION_EPOCH = datetime(1970, 1, 1)
+_location_queue: Optional[asyncio.Queue] = None
+_location_task: Optional[asyncio.Task] = None
+
+
+def _location_update(oid: ObjectId, lat: float, lng: float, ts: datetime) -> UpdateOne:
+    # Workers flush (and retry) independently, so a ping can reach MongoDB
+    # after a newer one; only apply it if it is newer than what is stored.
+    newer = {"$gt": [ts, {"$ifNull": ["$updated_at", _LOCATION_EPOCH]}]}
+    return UpdateOne(
+        {"_id": oid},
+        [{"$set": {
+            "lat": {"$cond": [newer, lat, "$lat"]},
+            "lng": {"$cond": [newer, lng, "$lng"]},
+            "updated_at": {"$cond": [newer, ts, "$updated_at"]},
+        }}],
+        upsert=True,
+    )
+
+
+async def _write_locations(pending: dict) -> bool:
+    ops = [_location_update(oid, lat, lng, ts) for oid, (lat, lng, ts) in pending.items()]
+    try:
+        await database.db["technician"].bulk_write(ops, ordered=False)
+        return True
+    except Exception:
+        logger.exception("Failed to write %d technician locations", len(ops))
+        return False
+
+
+async def _location_writer():
+    loop = asyncio.get_running_loop()
+    # a failed batch is kept and merged with newer pings for the next flush
+    pending = {}
+    stopping = False
+    while not stopping:
+        if not pending:
+            item = await _location_queue.get()
+            if item is None:
+                break
+            pending[item[0]] = item[1:]
+        deadline = loop.time() + _LOCATION_FLUSH_INTERVAL
+        while len(pending) < _LOCATION_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(_location_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                stopping = True
+                break
+            pending[item[0]] = item[1:]
+        if await _write_locations(pending):
+            pending = {}
+        elif stopping:
+            logger.error("Dropped %d technician locations at shutdown", len(pending))
+        else:
+            await asyncio.sleep(_LOCATION_FLUSH_INTERVAL)
+
+
+def _start_location_writer():
+    global _location_queue, _location_task
+    _location_queue = asyncio.Queue(maxsize=_LOCATION_QUEUE_SIZE)
+    _location_task = asyncio.create_task(_location_writer())
+
+
+async def _stop_location_writer():
+    # the None sentinel makes the writer flush its current batch and exit;
+    # give up after a timeout so a stalled database cannot block shutdown
+    global _location_queue, _location_task
+    if _location_task is None:
+        return
+    try:
+        _location_queue.put_nowait(None)
+        await asyncio.wait_for(_location_task, _LOCATION_STOP_TIMEOUT)
+    except (asyncio.QueueFull, asyncio.TimeoutError):
+        _location_task.cancel()
+        logger.error("Dropped queued technician locations at shutdown")
+    _location_queue = None
+    _location_task = None
+
+
+# Latest known locations are also kept in Redis (when configured) so
+# tracking reads rarely reach MongoDB.
+_LOCATION_CACHE_TTL = 5
+
+
+# Fills the cache only when the key is absent, so a value read from MongoDB
+# (which lags behind the batched writer) never replaces a newer ping.
+_CACHE_LOCATION_IF_ABSENT = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    redis.call("HSET", KEYS[1], "lat", ARGV[1], "lng", ARGV[2])
+    redis.call("EXPIRE", KEYS[1], ARGV[3])
+end
+"""
+
+
+def _location_key(oid: ObjectId) -> str:
+    return f"tech:{oid}"
+
+
+async def _cache_location(oid: ObjectId, lat: float, lng: float):
+    if database.cache is None:
+        return
+    key = _location_key(oid)
+    try:
+        async with database.cache.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping={"lat": lat, "lng": lng})
+            pipe.expire(key, _LOCATION_CACHE_TTL)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning("Failed to cache technician location: %s", e)
+
+
+async def _cache_location_if_absent(oid: ObjectId, lat: float, lng: float):
+    if database.cache is None:
+        return
+    try:
+        await database.cache.eval(
+            _CACHE_LOCATION_IF_ABSENT, 1, _location_key(oid), lat, lng, _LOCATION_CACHE_TTL
+        )
+    except Exception as e:
+        logger.warning("Failed to repopulate technician location cache: %s", e)
 
 
 @app.post("/track/update", response_model=dict)
-def update_technician_location(data: dict):
-    technician_id = data.get("technician_id")
-    lat = data.get("lat")
-    lng = data.get("lng")
-    if not technician_id or lat is None or lng is None:
-        raise HTTPException(400, detail="technician_id, lat, lng required")
-    r = db["technician"].update_one(
-        {"_id": _oid(technician_id)},
-        {"$set": {"lat": float(lat), "lng": float(lng), "updated_at": datetime.utcnow()}},
-        upsert=True,
-    )
+async def update_technician_location(payload: LocationBody):
+    if _location_queue is None:
+        raise HTTPException(503, detail="Database not available")
+    oid = _oid(payload.technician_id)
+    try:
+        _location_queue.put_nowait((oid, payload.lat, payload.lng, datetime.utcnow()))
+    except asyncio.QueueFull:
+        raise HTTPException(503, detail="Location updates are backed up, retry later")
+    await _cache_location(oid, payload.lat, payload.lng)
     return {"ok": True}
 
 
 @app.get("/track/{technician_id}", response_model=dict)
-def get_technician_location(technician_id: str):
-    doc = db["technician"].find_one({"_id": _oid(technician_id)})
-    if not doc:
+async def get_technician_location(technician_id: str):
+    oid = _oid(technician_id)
+    if database.cache is not None:
+        try:
+            lat, lng = await database.cache.hmget(_location_key(oid), "lat", "lng")
+            if lat is not None and lng is not None:
+                return {"lat": float(lat), "lng": float(lng)}
+        except Exception as e:
+            logger.warning("Failed to read technician location from cache: %s", e)
+    doc = await database.db["technician"].find_one(
+        {"_id": oid}, {"lat": 1, "lng": 1, "_id": 0}
+    )
+    if doc is None:
         raise HTTPException(404, detail="Technician not found")
-    return {"lat": doc.get("lat", 0), "lng": doc.get("lng", 0)}
+    location = {"lat": doc.get("lat", 0), "lng": doc.get("lng", 0)}
+    await _cache_location_if_absent(oid, location["lat"], location["lng"])
+    return location
 
 
 # Reviews
 @app.post("/reviews", response_model=dict)
-def create_review(payload: Review):
-    review_id = create_document("review", payload)
-    # update aggregate rating on technician
+async def create_review(payload: Review):
+    review_id = await create_document("review", payload)
+    # update running average rating on technician in a single round trip
     try:
         tid = payload.technician_id
-        reviews = db["review"].find({"technician_id": tid})
-        ratings = [r.get("rating", 0) for r in reviews]
-        if ratings:
-            avg = sum(ratings) / len(ratings)
-            db["technician"].update_one(
-                {"_id": _oid(tid)}, {"$set": {"rating_avg": avg, "rating_count": len(ratings)}}
-            )
+        count = {"$ifNull": ["$rating_count", 0]}
+        total = {"$multiply": [{"$ifNull": ["$rating_avg", 0]}, count]}
+        await database.db["technician"].update_one(
+            {"_id": _oid(tid)},
+            [{"$set": {
+                "rating_avg": {"$divide": [{"$add": [total, payload.rating]}, {"$add": [count, 1]}]},
+                "rating_count": {"$add": [count, 1]},
+            }}],
+        )
     except Exception:
         pass
     return {"id": review_id}
 
 
 @app.get("/technicians", response_model=List[dict])
-def list_technicians(limit: int = 50):
-    docs = get_documents("technician", {}, limit)
-    for d in docs:
-        d["id"] = str(d.get("_id"))
-        d.pop("_id", None)
-    return docs
+async def list_technicians(limit: int = Query(50, ge=1, le=MAX_LIST_LIMIT)):
+    return await get_documents("technician", {}, limit)
 
 
 # Payments (mock provider)
 @app.post("/payments/intent", response_model=dict)
-def create_payment_intent(payload: Payment):
+async def create_payment_intent(payload: Payment):
     # In real world, integrate Stripe/Adyen. Here we mock the flow.
-    tx_id = create_document("payment", payload)
-    db["payment"].update_one({"_id": _oid(tx_id)}, {"$set": {"status": "pending", "transaction_id": tx_id}})
+    # status and transaction id are server-owned: every intent starts pending and
+    # the document id doubles as the transaction id, whatever the client sent
+    tx_id = await create_document(
+        "payment",
+        payload.model_dump(exclude_unset=True, exclude={"status", "transaction_id"}),
+        {"status": "pending", "currency": payload.currency, "provider": payload.provider},
+    )
     return {"client_secret": f"mock_secret_{tx_id}", "transaction_id": tx_id}
 
 
 @app.post("/payments/confirm", response_model=dict)
-def confirm_payment(data: dict):
-    tx_id = data.get("transaction_id")
-    if not tx_id:
-        raise HTTPException(400, detail="transaction_id required")
-    db["payment"].update_one({"_id": _oid(tx_id)}, {"$set": {"status": "succeeded", "updated_at": datetime.utcnow()}})
-    return {"status": "succeeded"}
+async def confirm_payment(payload: ConfirmBody):
+    doc = await database.db["payment"].find_one_and_update(
+        {"_id": _oid(payload.transaction_id)},
+        {"$set": {"status": "succeeded", "updated_at": datetime.utcnow()}},
+        projection={"status": 1, "booking_id": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc is None:
+        raise HTTPException(404, detail="Payment not found")
+    return {"id": str(doc["_id"]), "status": doc["status"], "booking_id": doc.get("booking_id")}
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 2))
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+    )